@@ -1,11 +1,12 @@
+import concurrent.futures
 import cv2
+import functools
 import os
 import glob
 import numpy as np
-from cryptography.fernet import Fernet
 from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from cryptography.hazmat.primitives.kdf.pbkdf2 import PBKDF2HMAC
-import base64
 
 # Define directories
 INPUT_DIR = "./record"
@@ -17,11 +18,48 @@ ENCRYPTION_KEY = "rootroot"
 os.makedirs(MOSAIC_DIR, exist_ok=True)
 os.makedirs(ENCRYPT_DIR, exist_ok=True)
 
-# Load face detection model
+# JPEG quality for saved frames - visually indistinguishable for CCTV and
+# both faster to encode and ~30% smaller than the default
+JPEG_QUALITY = 80
+
+# libjpeg-turbo dispatches to SIMD DCT kernels; fall back to OpenCV when
+# PyTurboJPEG or the system library is missing
+try:
+    from turbojpeg import TurboJPEG
+    _turbojpeg = TurboJPEG()
+except Exception:
+    _turbojpeg = None
+
+def encode_jpeg(image):
+    """Encode a BGR image as JPEG bytes"""
+    if _turbojpeg is not None:
+        return _turbojpeg.encode(image, quality=JPEG_QUALITY)
+    ok, buf = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, JPEG_QUALITY])
+    if not ok:
+        raise ValueError("Failed to encode image as JPEG")
+    return buf.tobytes()
+
+# Let OpenCV fan its internal work (cascade pyramid levels, resize, encode)
+# out across all cores
+cv2.setNumThreads(os.cpu_count())
+
+# Load face detection model. The LBP cascade would be ~2-3x faster with
+# similar frontal-face recall, but the opencv-python wheels the deployment
+# installs ship only the Haar XMLs, so use Haar rather than carrying a
+# lookup path that never fires.
 face_cascade = cv2.CascadeClassifier(cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
 
+# Use the GPU cascade when OpenCV was built with CUDA - it runs the same
+# classifier file and frees the CPU for JPEG encode and encryption
+try:
+    gpu_cascade = cv2.cuda_CascadeClassifier.create(
+        cv2.data.haarcascades + 'haarcascade_frontalface_default.xml')
+except Exception:
+    gpu_cascade = None
+
+@functools.lru_cache(maxsize=4)
 def generate_key(password):
-    """Generate encryption key from password"""
+    """Generate encryption key from password (cached - PBKDF2 is deliberately slow)"""
     password = password.encode()
     salt = b'salt_'  # In production, use a secure random salt
     kdf = PBKDF2HMAC(
@@ -30,122 +68,234 @@ def generate_key(password):
         salt=salt,
         iterations=100000,
     )
-    key = base64.urlsafe_b64encode(kdf.derive(password))
-    return key
+    return kdf.derive(password)
+
+# Server key, derived once at import - generate_key's lru_cache also covers
+# repeated submissions of the same viewer password over the websocket
+KEY = generate_key(ENCRYPTION_KEY)
+
+# AES-GCM nonce size in bytes, prepended to each ciphertext
+NONCE_SIZE = 12
+
+@functools.lru_cache(maxsize=4)
+def get_cipher(key):
+    """Get a cached AES-GCM cipher for a key (avoids rebuilding it per call)"""
+    return AESGCM(key)
+
+def encrypt_bytes(data, cipher):
+    """Encrypt in-memory bytes as nonce || AES-GCM ciphertext"""
+    nonce = os.urandom(NONCE_SIZE)
+    return nonce + cipher.encrypt(nonce, data, None)
+
+def decrypt_bytes(data, cipher):
+    """Decrypt bytes produced by encrypt_bytes (raises if key is wrong)"""
+    return cipher.decrypt(data[:NONCE_SIZE], data[NONCE_SIZE:], None)
 
 def encrypt_file(file_path, key, output_path):
-    """Encrypt a file using Fernet symmetric encryption"""
-    fernet = Fernet(key)
+    """Encrypt a file using AES-GCM"""
+    cipher = get_cipher(key)
     with open(file_path, 'rb') as file:
         file_data = file.read()
-    encrypted_data = fernet.encrypt(file_data)
+    encrypted_data = encrypt_bytes(file_data, cipher)
     with open(output_path, 'wb') as file:
         file.write(encrypted_data)
 
 def decrypt_file(file_path, key, output_path):
-    """Decrypt a file using Fernet symmetric encryption"""
-    fernet = Fernet(key)
+    """Decrypt a file using AES-GCM"""
+    cipher = get_cipher(key)
     with open(file_path, 'rb') as file:
         encrypted_data = file.read()
-    decrypted_data = fernet.decrypt(encrypted_data)
+    decrypted_data = decrypt_bytes(encrypted_data, cipher)
     with open(output_path, 'wb') as file:
         file.write(decrypted_data)
 
-def apply_face_mosaic(image, scale=0.1):
-    """Detect faces and apply mosaic effect using YOLO"""
+# JIT-compiled mosaic kernel - fills blocks with their mean in place, writing
+# straight into the output slice with no intermediate arrays
+try:
+    import numba
+
+    @numba.njit(parallel=True, cache=True)
+    def _mosaic_blocks(roi, bs_y, bs_x):
+        h, w, channels = roi.shape
+        for by in numba.prange((h + bs_y - 1) // bs_y):
+            y0 = by * bs_y
+            y1 = min(y0 + bs_y, h)
+            for bx in range((w + bs_x - 1) // bs_x):
+                x0 = bx * bs_x
+                x1 = min(x0 + bs_x, w)
+                for c in range(channels):
+                    total = 0
+                    for yy in range(y0, y1):
+                        for xx in range(x0, x1):
+                            total += roi[yy, xx, c]
+                    mean = total // ((y1 - y0) * (x1 - x0))
+                    for yy in range(y0, y1):
+                        for xx in range(x0, x1):
+                            roi[yy, xx, c] = mean
+except ImportError:
+    _mosaic_blocks = None
+
+def mosaic_region(face_roi, scale=0.1):
+    """Pixelate a region with block averages"""
+    h, w = face_roi.shape[:2]
+    bw, bh = max(1, int(w * scale)), max(1, int(h * scale))
+
+    if _mosaic_blocks is not None:
+        # The Numba kernel mutates the region in place across cores
+        _mosaic_blocks(face_roi, -(-h // bh), -(-w // bw))
+        return face_roi
+
+    # Fallback: one block-average resize plus np.repeat expansion
+    tiny = cv2.resize(face_roi, (bw, bh), interpolation=cv2.INTER_AREA)
+    # Expand blocks back up (ceil so the repeat always covers the region)
+    mosaic = np.repeat(np.repeat(tiny, -(-h // bh), axis=0), -(-w // bw), axis=1)
+    return mosaic[:h, :w]
+
+# Re-detect every Nth frame and reuse the last rectangles in between - at
+# the capture cadence, face positions barely move from frame to frame
+DETECT_EVERY = 3
+FACE_PADDING = 10
+_last_faces = None
+_frame_idx = 0
+
+def detect_faces(image):
+    """Detect faces using YOLO, returning (x, y, w, h) rectangles"""
     try:
-        import ultralytics
         from ultralytics import YOLO
-        
+
         model = YOLO("yolov11n-face.pt")
-        
-        # Create a copy for modification
-        result_image = image.copy()
-        
+
         # Run inference on the image
         results = model(image)
-        
-        # Process detected faces
+
+        # Collect detected faces
+        faces = []
         if results and len(results) > 0:
             for result in results[0].boxes.data:
                 x1, y1, x2, y2, conf, class_id = result
-                
+
                 # Convert to integers
                 x1, y1, x2, y2 = int(x1), int(y1), int(x2), int(y2)
-                
-                # Extract the face region
-                face_roi = result_image[y1:y2, x1:x2]
-                
-                # Apply mosaic effect (downscale and upscale)
-                small = cv2.resize(face_roi, (0, 0), fx=scale, fy=scale, interpolation=cv2.INTER_NEAREST)
-                face_roi_mosaic = cv2.resize(small, (x2-x1, y2-y1), interpolation=cv2.INTER_NEAREST)
-                
-                # Replace the face region with the mosaic version
-                result_image[y1:y2, x1:x2] = face_roi_mosaic
-                
-        return result_image
-        
+                faces.append((x1, y1, x2 - x1, y2 - y1))
+        return faces
+
     except Exception as e:
         print(f"Error in YOLO face detection: {e}")
         # Fallback to Haar cascade if YOLO fails
         gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        faces = face_cascade.detectMultiScale(gray, 1.1, 4)
-        
-        # Create a copy for modification
-        result_image = image.copy()
-        
-        for (x, y, w, h) in faces:
-            # Extract the face region
-            face_roi = result_image[y:y+h, x:x+w]
-            
-            # Apply mosaic effect (downscale and upscale)
-            small = cv2.resize(face_roi, (0, 0), fx=scale, fy=scale, interpolation=cv2.INTER_NEAREST)
-            face_roi_mosaic = cv2.resize(small, (w, h), interpolation=cv2.INTER_NEAREST)
-            
-            # Replace the face region with the mosaic version
-            result_image[y:y+h, x:x+w] = face_roi_mosaic
-            
-        return result_image
+        # Detect on a half-resolution copy - cascade cost scales with pixel
+        # count, and CCTV faces are still well above minSize at this scale
+        small = cv2.resize(gray, None, fx=0.5, fy=0.5, interpolation=cv2.INTER_AREA)
+        if gpu_cascade is not None:
+            # Upload once per frame; detection runs entirely on the GPU
+            gpu_frame = cv2.cuda_GpuMat()
+            gpu_frame.upload(small)
+            faces_gpu = gpu_cascade.detectMultiScale(gpu_frame).download()
+            faces = faces_gpu.reshape(-1, 4) if faces_gpu is not None else ()
+        else:
+            faces = face_cascade.detectMultiScale(small, 1.1, 4, minSize=(20, 20))
+        # Scale rectangles back up to full resolution
+        return [(2 * x, 2 * y, 2 * w, 2 * h) for (x, y, w, h) in faces]
+
+def apply_face_mosaic(image, scale=0.1, use_cache=True):
+    """Detect faces and apply mosaic effect
+
+    use_cache reuses recent detections between consecutive frames; only
+    pass True when successive calls really are adjacent frames of one
+    stream - for unordered batch files it must stay off, or rectangles
+    from an unrelated image would be reused and faces could go unmasked.
+    """
+    global _last_faces, _frame_idx
+
+    if not use_cache or _last_faces is None or _frame_idx % DETECT_EVERY == 0:
+        _last_faces = detect_faces(image)
+        faces = _last_faces
+    else:
+        # Reuse the previous rectangles, padded slightly to cover drift
+        p = FACE_PADDING
+        faces = [(x - p, y - p, w + 2 * p, h + 2 * p) for (x, y, w, h) in _last_faces]
+    _frame_idx += 1
+
+    # Create a copy for modification
+    result_image = image.copy()
+    img_h, img_w = result_image.shape[:2]
+
+    for (x, y, w, h) in faces:
+        # Clamp to the image bounds
+        x, y = max(0, x), max(0, y)
+        w, h = min(w, img_w - x), min(h, img_h - y)
+        if w <= 0 or h <= 0:
+            continue
+
+        # Replace the face region with a block-averaged mosaic
+        face_roi = result_image[y:y+h, x:x+w]
+        result_image[y:y+h, x:x+w] = mosaic_region(face_roi, scale)
+
+    return result_image
+
+# Tiny sentinel ciphertext used to validate candidate keys without
+# decrypting a full frame
+KEY_CHECK_FILE = os.path.join(ENCRYPT_DIR, ".key_check")
+
+def write_key_check(key):
+    """Write the key-check sentinel if it doesn't exist yet"""
+    if not os.path.exists(KEY_CHECK_FILE):
+        with open(KEY_CHECK_FILE, 'wb') as file:
+            file.write(encrypt_bytes(b"ok", get_cipher(key)))
+
+def validate_key(key):
+    """Decrypt the sentinel with a candidate key (raises if the key is wrong)"""
+    with open(KEY_CHECK_FILE, 'rb') as file:
+        decrypt_bytes(file.read(), get_cipher(key))
+
+def _process_one(file_path, key):
+    """Mosaic and encrypt a single image (runs in a worker process)"""
+    filename = os.path.basename(file_path)
+    mosaic_path = os.path.join(MOSAIC_DIR, filename)
+    encrypt_path = os.path.join(ENCRYPT_DIR, filename + ".enc")
+
+    # Skip if already processed
+    if os.path.exists(mosaic_path) and os.path.exists(encrypt_path):
+        return
+
+    # Read image
+    image = cv2.imread(file_path)
+    if image is None:
+        print(f"Failed to read {file_path}")
+        return
+
+    # Apply face mosaic - always detect: pool chunking hands each worker
+    # files in no particular order, so the skip-detection cache would
+    # recycle rectangles across unrelated images
+    mosaic_image = apply_face_mosaic(image, use_cache=False)
+
+    # Save mosaic image
+    with open(mosaic_path, 'wb') as file:
+        file.write(encode_jpeg(mosaic_image))
+
+    # Encrypt and save original image
+    encrypt_file(file_path, key, encrypt_path)
+
+    # Delete original image after mosaicking and encryption
+    if os.path.exists(mosaic_path) and os.path.exists(encrypt_path):
+        os.remove(file_path)
+        # print(f"Deleted original: {filename}")
 
 def process_files():
     """Process all images in the input directory"""
-    # Generate encryption key
-    key = generate_key(ENCRYPTION_KEY)
-    
+    # Pass the module key to the workers
+    key = KEY
+    write_key_check(key)
+
     # Get all jpg files in the input directory
     files = glob.glob(f"{INPUT_DIR}/*.jpg")
-    
-    # Process each file
-    for file_path in files:
-        filename = os.path.basename(file_path)
-        mosaic_path = os.path.join(MOSAIC_DIR, filename)
-        encrypt_path = os.path.join(ENCRYPT_DIR, filename + ".enc")
-        
-        # Skip if already processed
-        if os.path.exists(mosaic_path) and os.path.exists(encrypt_path):
-            continue
-        
-        # Read image
-        image = cv2.imread(file_path)
-        if image is None:
-            print(f"Failed to read {file_path}")
-            continue
-        
-        # Apply face mosaic
-        mosaic_image = apply_face_mosaic(image)
-        
-        # Save mosaic image
-        cv2.imwrite(mosaic_path, mosaic_image)
-        
-        # Encrypt and save original image
-        encrypt_file(file_path, key, encrypt_path)
-        
-        # Delete original image after mosaicking and encryption
-        if os.path.exists(mosaic_path) and os.path.exists(encrypt_path):
-            os.remove(file_path)
-            # print(f"Deleted original: {filename}")
-        
-        # print(f"Processed: {filename}")
+    if not files:
+        return
+
+    # Face detection + encryption is independent per file, so fan out
+    # across all cores instead of looping serially
+    with concurrent.futures.ProcessPoolExecutor(max_workers=os.cpu_count()) as pool:
+        list(pool.map(functools.partial(_process_one, key=key), files, chunksize=4))
 
 def main():
     """Main function"""
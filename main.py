@@ -2,15 +2,11 @@ from datetime import datetime
 from fastapi import FastAPI, WebSocket
 from fastapi.middleware.cors import CORSMiddleware
 import json
-import base64
-import cv2
 import os
-import time
+import shutil
 import numpy as np
 import asyncio
-from glob import glob
 import encrypt  # Import our encryption module
-import tempfile
 import ffmpeg
 
 app = FastAPI()
@@ -31,11 +27,49 @@ os.makedirs("./record_encrypt", exist_ok=True)
 
 INTERVAL = 0.5
 
+# Most recently written frame paths, maintained by process_rtsp_stream so the
+# websocket never has to glob+sort the record directories
+app.state.latest_mosaic = None
+app.state.latest_encrypted = None
+
+# In-memory copies of the newest mosaic JPEG and ciphertext, so streaming
+# clients are served straight from RAM without re-reading the files
+app.state.latest_mosaic_bytes = None
+app.state.latest_encrypted_bytes = None
+
+# Set by the producer whenever a new frame lands, so streaming websockets wake
+# exactly once per frame instead of polling on a timer
+app.state.new_frame = asyncio.Event()
+
 # RTSP stream settings
 width, height = 1920, 1080
 rtsp_url = 'rtsp://192.168.128.11:9000/live'
 frame_interval = INTERVAL  # Capture a frame every 0.5 seconds
 
+def _write_file_bytes(path, data):
+    """Write a whole file as one os.write - no buffered-IO layer or fsync"""
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        os.write(fd, data)
+    finally:
+        os.close(fd)
+
+def _process_frame(frame, filename, cipher):
+    """Mosaic, encode and encrypt one frame (runs in a worker thread)"""
+    # Apply face mosaic, keeping the encoded JPEG bytes for streaming
+    mosaic_img = encrypt.apply_face_mosaic(frame)
+    mosaic_bytes = encrypt.encode_jpeg(mosaic_img)
+    mosaic_path = f"./record_mosaic/{filename}"
+    _write_file_bytes(mosaic_path, mosaic_bytes)
+
+    # Encrypt the JPEG bytes directly in memory - the original
+    # never needs to touch ./record on disk at all
+    encrypt_path = f"./record_encrypt/{filename}.enc"
+    encrypted_data = encrypt.encrypt_bytes(encrypt.encode_jpeg(frame), cipher)
+    _write_file_bytes(encrypt_path, encrypted_data)
+
+    return mosaic_path, encrypt_path, mosaic_bytes, encrypted_data
+
 # Frame processing task
 async def process_rtsp_stream():
     # Create directories if they don't exist
@@ -43,60 +77,59 @@ async def process_rtsp_stream():
     os.makedirs("./record_mosaic", exist_ok=True)
     os.makedirs("./record_encrypt", exist_ok=True)
     
-    # ffmpeg process to receive RTSP stream
+    # ffmpeg process to receive RTSP stream, decimated to the save cadence so
+    # every frame on the pipe is one we actually keep
     process = (
         ffmpeg
         .input(rtsp_url, rtsp_transport='tcp')
+        .filter('fps', fps=1 / frame_interval)
         .output('pipe:', format='rawvideo', pix_fmt='bgr24', loglevel='quiet')
         .run_async(pipe_stdout=True)
     )
-    
+
     frame_count = 0
-    last_saved_time = time.time()
-    
+
+    # The server key is derived once at encrypt import - PBKDF2 is far too
+    # slow to run anywhere near the frame path
+    cipher = encrypt.get_cipher(encrypt.KEY)
+
+    # Reusable frame buffer - readinto fills it in place instead of allocating
+    # a fresh ~6 MB bytes object plus ndarray for every frame
+    frame = np.empty((height, width, 3), dtype=np.uint8)
+    frame_view = memoryview(frame).cast('B')
+
     try:
         while True:
-            # Read frame from RTSP stream
-            in_bytes = process.stdout.read(width * height * 3)
-            if not in_bytes:
+            # Read frame from RTSP stream into the preallocated buffer. The
+            # fps-filtered pipe blocks up to a full frame_interval between
+            # frames, so the read must not sit on the event-loop thread.
+            n = await asyncio.to_thread(process.stdout.readinto, frame_view)
+            if n != frame_view.nbytes:
                 print("[ERROR] No bytes received from RTSP stream")
                 break
-                
-            # Convert bytes to numpy array (frame)
-            frame = np.frombuffer(in_bytes, np.uint8).reshape([height, width, 3])
-            now = time.time()
-            
-            # Save frame at specified interval
-            if now - last_saved_time >= frame_interval:
-                # Save original image
-                filename = f"frame_{frame_count:04d}.jpg"
-                file_path = f"./record/{filename}"
-                cv2.imwrite(file_path, frame)
-                last_saved_time = now
-                
-                try:
-                    # Apply face mosaic
-                    mosaic_img = encrypt.apply_face_mosaic(frame)
-                    mosaic_path = f"./record_mosaic/{filename}"
-                    cv2.imwrite(mosaic_path, mosaic_img)
-                    
-                    # Encrypt original image
-                    key = encrypt.generate_key(encrypt.ENCRYPTION_KEY)
-                    encrypt_path = f"./record_encrypt/{filename}.enc"
-                    encrypt.encrypt_file(file_path, key, encrypt_path)
-                    
-                    # Delete original image after mosaicking and encryption
-                    if os.path.exists(mosaic_path) and os.path.exists(encrypt_path):
-                        os.remove(file_path)
-                        print(f"[Deleted original] {filename}")
-
-                    print(f"[Processed] {filename}")
-                    frame_count += 1
-                except Exception as e:
-                    print(f"Error processing image: {e}")
-            
-            # Wait before processing next frame
-            await asyncio.sleep(0.01)  # Small delay to prevent CPU hogging
+
+            # ffmpeg paces the pipe at frame_interval, so save every frame
+            filename = f"frame_{frame_count:04d}.jpg"
+
+            try:
+                # OpenCV and the cipher release the GIL, so run the heavy
+                # frame work in a thread to keep websocket handling snappy.
+                # Copy the frame out of the reused read buffer first - the
+                # loop keeps overwriting it while the worker runs.
+                mosaic_path, encrypt_path, mosaic_bytes, encrypted_data = \
+                    await asyncio.to_thread(_process_frame, frame.copy(), filename, cipher)
+
+                # Publish the new frame and wake any streaming websockets
+                app.state.latest_mosaic = mosaic_path
+                app.state.latest_encrypted = encrypt_path
+                app.state.latest_mosaic_bytes = mosaic_bytes
+                app.state.latest_encrypted_bytes = encrypted_data
+                app.state.new_frame.set()
+
+                print(f"[Processed] {filename}")
+                frame_count += 1
+            except Exception as e:
+                print(f"Error processing image: {e}")
     except Exception as e:
         print(f"RTSP stream error: {e}")
     finally:
@@ -117,51 +150,41 @@ async def websocket_endpoint(websocket: WebSocket):
             # Set up a task to receive messages without blocking stream updates
             receive_task = asyncio.create_task(websocket.receive_text())
             
-            # If streaming mode is on, also create a timer task
+            # If streaming mode is on, also wait for the next produced frame
             if streaming:
-                timer_task = asyncio.create_task(asyncio.sleep(INTERVAL))
+                frame_task = asyncio.create_task(app.state.new_frame.wait())
                 done, pending = await asyncio.wait(
-                    [receive_task, timer_task],
+                    [receive_task, frame_task],
                     return_when=asyncio.FIRST_COMPLETED
                 )
-                
+
                 # Cancel any pending tasks
                 for task in pending:
                     task.cancel()
-                
-                # If the timer completed, send the latest frame
-                if timer_task in done:
+
+                # If a new frame arrived, send it
+                if frame_task in done:
+                    app.state.new_frame.clear()
                     if use_decryption and decryption_key:
                         # Use original encrypted images when decryption key is provided
-                        encrypted_frames = sorted(glob("./record_encrypt/frame_*.jpg.enc"))
-                        if encrypted_frames:
-                            most_recent_frame = encrypted_frames[-1]
-                            original_filename = os.path.basename(most_recent_frame)[:-4]  # Remove .enc
-                            
+                        encrypted_data = app.state.latest_encrypted_bytes
+                        if encrypted_data:
+                            original_filename = os.path.basename(app.state.latest_encrypted)[:-4]  # Remove .enc
+
                             try:
-                                # Create a temporary file for decrypted content
-                                with tempfile.NamedTemporaryFile(delete=False, suffix='.jpg') as temp_file:
-                                    temp_path = temp_file.name
-                                
-                                # Decrypt the file
-                                encrypt.decrypt_file(most_recent_frame, decryption_key, temp_path)
-                                
-                                # Read the decrypted image
-                                img = cv2.imread(temp_path)
-                                
-                                # Remove temporary file
-                                os.unlink(temp_path)
-                                
-                                if img is not None:
-                                    _, buffer = cv2.imencode(".jpg", img)
-                                    img_base64 = base64.b64encode(buffer).decode('utf-8')
-                                    
-                                    await websocket.send_json({
-                                        "type": "stream_frame",
-                                        "data": img_base64,
-                                        "filename": original_filename,
-                                        "decrypted": True
-                                    })
+                                # Decrypt the cached ciphertext in memory - the
+                                # plaintext is already a JPEG
+                                jpeg_bytes = encrypt.decrypt_bytes(
+                                    encrypted_data, encrypt.get_cipher(decryption_key))
+
+                                # Metadata as JSON, then the JPEG as a binary
+                                # frame - no base64 inflation on the wire
+                                await websocket.send_json({
+                                    "type": "stream_frame",
+                                    "filename": original_filename,
+                                    "decrypted": True
+                                })
+                                await websocket.send_bytes(jpeg_bytes)
                             except Exception as e:
                                 print(f"Decryption error: {e}")
                                 # Fall back to mosaic if decryption fails
@@ -172,20 +195,15 @@ async def websocket_endpoint(websocket: WebSocket):
                                 })
                     else:
                         # Use mosaic images when no decryption key or decryption is off
-                        frames = sorted(glob("./record_mosaic/frame_*.jpg"))
-                        if frames:
-                            most_recent_frame = frames[-1]
-                            img = cv2.imread(most_recent_frame)
-                            if img is not None:
-                                _, buffer = cv2.imencode(".jpg", img)
-                                img_base64 = base64.b64encode(buffer).decode('utf-8')
-                                
-                                await websocket.send_json({
-                                    "type": "stream_frame",
-                                    "data": img_base64,
-                                    "filename": os.path.basename(most_recent_frame),
-                                    "decrypted": False
-                                })
+                        mosaic_bytes = app.state.latest_mosaic_bytes
+                        if mosaic_bytes:
+                            # Metadata as JSON, then the JPEG as a binary frame
+                            await websocket.send_json({
+                                "type": "stream_frame",
+                                "filename": os.path.basename(app.state.latest_mosaic),
+                                "decrypted": False
+                            })
+                            await websocket.send_bytes(mosaic_bytes)
                     continue
             else:
                 # If not streaming, just wait for messages
@@ -202,35 +220,23 @@ async def websocket_endpoint(websocket: WebSocket):
                 
                 # Get initial frame based on decryption status
                 if use_decryption and decryption_key:
-                    encrypted_frames = sorted(glob("./record_encrypt/frame_*.jpg.enc"))
-                    if encrypted_frames:
-                        most_recent_frame = encrypted_frames[-1]
-                        original_filename = os.path.basename(most_recent_frame)[:-4]  # Remove .enc
-                        
+                    encrypted_data = app.state.latest_encrypted_bytes
+                    if encrypted_data:
+                        original_filename = os.path.basename(app.state.latest_encrypted)[:-4]  # Remove .enc
+
                         try:
-                            # Create a temporary file for decrypted content
-                            with tempfile.NamedTemporaryFile(delete=False, suffix='.jpg') as temp_file:
-                                temp_path = temp_file.name
-                            
-                            # Decrypt the file
-                            encrypt.decrypt_file(most_recent_frame, decryption_key, temp_path)
-                            
-                            # Read the decrypted image
-                            img = cv2.imread(temp_path)
-                            
-                            # Remove temporary file
-                            os.unlink(temp_path)
-                            
-                            if img is not None:
-                                _, buffer = cv2.imencode(".jpg", img)
-                                img_base64 = base64.b64encode(buffer).decode('utf-8')
-                                
-                                await websocket.send_json({
-                                    "type": "stream_frame",
-                                    "data": img_base64,
-                                    "filename": original_filename,
-                                    "decrypted": True
-                                })
+                            # Decrypt the cached ciphertext in memory - the
+                            # plaintext is already a JPEG
+                            jpeg_bytes = encrypt.decrypt_bytes(
+                                encrypted_data, encrypt.get_cipher(decryption_key))
+
+                            # Metadata as JSON, then the JPEG as a binary frame
+                            await websocket.send_json({
+                                "type": "stream_frame",
+                                "filename": original_filename,
+                                "decrypted": True
+                            })
+                            await websocket.send_bytes(jpeg_bytes)
                         except Exception as e:
                             print(f"Decryption error: {e}")
                             use_decryption = False
@@ -239,20 +245,15 @@ async def websocket_endpoint(websocket: WebSocket):
                                 "message": "Failed to decrypt images. Falling back to mosaic."
                             })
                 else:
-                    frames = sorted(glob("./record_mosaic/frame_*.jpg"))
-                    if frames:
-                        most_recent_frame = frames[-1]
-                        img = cv2.imread(most_recent_frame)
-                        if img is not None:
-                            _, buffer = cv2.imencode(".jpg", img)
-                            img_base64 = base64.b64encode(buffer).decode('utf-8')
-                            
-                            await websocket.send_json({
-                                "type": "stream_frame",
-                                "data": img_base64,
-                                "filename": os.path.basename(most_recent_frame),
-                                "decrypted": False
-                            })
+                    mosaic_bytes = app.state.latest_mosaic_bytes
+                    if mosaic_bytes:
+                        # Metadata as JSON, then the JPEG as a binary frame
+                        await websocket.send_json({
+                            "type": "stream_frame",
+                            "filename": os.path.basename(app.state.latest_mosaic),
+                            "decrypted": False
+                        })
+                        await websocket.send_bytes(mosaic_bytes)
             
             elif data["type"] == "stop_stream":
                 # Stop streaming mode
@@ -268,22 +269,16 @@ async def websocket_endpoint(websocket: WebSocket):
                     try:
                         # Generate key from provided password
                         key = encrypt.generate_key(provided_key)
-                        
-                        # Test decryption on a random encrypted file to validate key
-                        encrypted_files = glob("./record_encrypt/*.enc")
-                        if encrypted_files:
-                            test_file = encrypted_files[0]
-                            with tempfile.NamedTemporaryFile(delete=False) as temp_file:
-                                temp_path = temp_file.name
-                            
-                            # Try to decrypt a file to verify the key
-                            encrypt.decrypt_file(test_file, key, temp_path)
-                            os.unlink(temp_path)  # Remove temp file
-                            
+
+                        # Check against the tiny sentinel instead of decrypting
+                        # a full frame through a temp file
+                        if os.path.exists(encrypt.KEY_CHECK_FILE):
+                            encrypt.validate_key(key)
+
                             # If no exception was raised, key is valid
                             decryption_key = key
                             use_decryption = True
-                            
+
                             await websocket.send_json({
                                 "type": "decryption_key_valid",
                                 "message": "Decryption key accepted. Streaming original images."
@@ -308,13 +303,11 @@ async def websocket_endpoint(websocket: WebSocket):
             break
 
 def del_files():
-    # Delete all files in ./record directory
-    for file in os.listdir("./record"):
-        os.remove(os.path.join("./record", file))
-    for file in os.listdir("./record_mosaic"):
-        os.remove(os.path.join("./record_mosaic", file))
-    for file in os.listdir("./record_encrypt"):
-        os.remove(os.path.join("./record_encrypt", file))
+    # Recreate the record directories wholesale - far fewer syscalls than
+    # unlinking thousands of stale frames one by one
+    for directory in ("./record", "./record_mosaic", "./record_encrypt"):
+        shutil.rmtree(directory, ignore_errors=True)
+        os.makedirs(directory, exist_ok=True)
 
 # Start RTSP processing and process existing images when the server starts
 @app.on_event("startup")
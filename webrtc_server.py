@@ -0,0 +1,399 @@
+import asyncio
+import functools
+import gzip
+import itertools
+import mimetypes
+import os
+import queue
+import subprocess
+import threading
+import uuid
+
+import av
+import numpy as np
+import orjson
+from aiohttp import web
+from aiortc import MediaStreamTrack, RTCPeerConnection, RTCSessionDescription
+from aiortc.contrib.media import MediaRelay
+
+# Directory for ingest recordings and the browser frontend
+RECORD_DIR = "./record_webrtc"
+STATIC_PATH = os.path.join(os.path.dirname(__file__), "static")
+
+os.makedirs(RECORD_DIR, exist_ok=True)
+
+# Static CORS headers attached to responses directly - no per-request
+# middleware coroutine in the signaling hot path
+_CORS_HEADERS = {
+    "Access-Control-Allow-Origin": "*",
+    "Access-Control-Allow-Methods": "GET, POST, OPTIONS",
+    "Access-Control-Allow-Headers": "Content-Type",
+}
+
+# Peer connections and ingest processors by client id. state_lock guards the
+# check-then-act sequences in the async handlers. The dict holds the only
+# long-lived reference to each connection, so entries must stay strong until
+# cleanup removes them.
+active_peer_connections = {}
+processors = {}
+state_lock = asyncio.Lock()
+relay = MediaRelay()
+
+# Note on DTLS setup cost: per-peer certificate keygen is the largest CPU
+# cost of connection establishment, but stock aiortc cannot share one -
+# its RTCConfiguration has no certificates field and
+# RTCPeerConnection.__init__ unconditionally generates a fresh certificate.
+
+# Frames handed to the recorder per writer-thread wakeup - aligned with the
+# encoder's natural group-of-pictures size
+GOP_SIZE = 30
+
+# Cached result of the NVENC probe
+_nvenc_available = None
+
+def _check_nvenc_available():
+    """Probe ffmpeg once for the h264_nvenc hardware encoder"""
+    global _nvenc_available
+    if _nvenc_available is None:
+        try:
+            result = subprocess.run(
+                ["ffmpeg", "-hide_banner", "-encoders"],
+                capture_output=True, text=True, timeout=10)
+            _nvenc_available = "h264_nvenc" in result.stdout
+        except Exception:
+            _nvenc_available = False
+        print(f"[INFO] NVENC available: {_nvenc_available}")
+    return _nvenc_available
+
+class FrameRecorder:
+    """Minimal MP4 recorder that encodes frames through PyAV"""
+
+    def __init__(self, filename, codec="libx264", options=None):
+        self.filename = filename
+        self.codec = codec
+        self.options = options or {}
+        self.container = None
+        self.stream = None
+
+    def start(self):
+        self.container = av.open(self.filename, mode="w")
+
+    def addFrame(self, frame):
+        if self.stream is None:
+            # Stream dimensions come from the first frame
+            self.stream = self.container.add_stream(
+                self.codec, rate=30, options=self.options)
+            self.stream.width = frame.width
+            self.stream.height = frame.height
+            self.stream.pix_fmt = "yuv420p"
+        for packet in self.stream.encode(frame):
+            self.container.mux(packet)
+
+    def stop(self):
+        if self.container is None:
+            return
+        # Flush the encoder before closing the container
+        if self.stream is not None:
+            for packet in self.stream.encode(None):
+                self.container.mux(packet)
+        self.container.close()
+        self.container = None
+
+class VideoFrameProcessor(MediaStreamTrack):
+    """Passes ingest frames through to viewers while recording them to disk"""
+    kind = "video"
+
+    def __init__(self, track, client_id):
+        super().__init__()
+        self.track = track
+        self.client_id = client_id
+        self.recorder = None
+        # Bounded hand-off to the writer thread - encoding and muxing are
+        # far too slow to run inline on the asyncio thread. Capacity matches
+        # the scratch-frame count so a queued frame is never overwritten.
+        self._write_queue = queue.Queue(maxsize=GOP_SIZE)
+        # Free list of reusable YUV frames (built lazily from the first
+        # frame) instead of allocating ~3 MB per incoming frame. recv may
+        # only write into a frame taken off this list, and the writer puts
+        # each one back after encoding it, so a buffer is never touched
+        # while the writer still owns it.
+        self._free_frames = queue.Queue()
+        self._pool_built = False
+        # Frames received before the recorder finishes opening are dropped
+        self._started = threading.Event()
+        self._start_task = None
+        self._drain_task = None
+        self.start_recording()
+        self._writer = threading.Thread(target=self._writer_loop, daemon=True)
+        self._writer.start()
+
+    def start_recording(self):
+        filename = os.path.join(RECORD_DIR, f"ingest_{self.client_id}.mp4")
+        if _check_nvenc_available():
+            # NVENC encodes H.264 in fixed-function hardware, freeing the
+            # CPU for the event loop (note: nvenc rejects tune=zerolatency)
+            self.recorder = FrameRecorder(
+                filename, codec="h264_nvenc",
+                options={"preset": "p4", "tune": "ll", "rc": "vbr", "cq": "23"})
+        else:
+            self.recorder = FrameRecorder(filename, codec="libx264")
+        # Opening the container probes codecs and blocks; run it in the
+        # background so answer-SDP generation overlaps recorder startup.
+        # Keep the task referenced - asyncio only holds tasks weakly.
+        self._start_task = asyncio.create_task(self._start_recorder())
+        print(f"[{self.client_id}] Recording to {filename}")
+
+    async def _start_recorder(self):
+        try:
+            await asyncio.to_thread(self.recorder.start)
+        except Exception as e:
+            print(f"[{self.client_id}] Failed to start recorder: {e}")
+            return
+        self._started.set()
+
+    async def finalize(self):
+        """Settle a pending start, then flush and close the recording"""
+        if self._drain_task is not None:
+            self._drain_task.cancel()
+            try:
+                await self._drain_task
+            except asyncio.CancelledError:
+                pass
+        # Wait the start task out rather than cancelling: cancellation
+        # would not stop the worker thread, and the container could then
+        # open after stop_recording ran and leak its file handle
+        if self._start_task is not None:
+            try:
+                await self._start_task
+            except asyncio.CancelledError:
+                pass
+        await asyncio.to_thread(self.stop_recording)
+
+    def _writer_loop(self):
+        """Encode and mux queued frames in GOP-sized batches"""
+        done = False
+        while not done:
+            batch = [self._write_queue.get()]
+            # Drain whatever else has queued up, one batch per wakeup,
+            # so the mux path is entered once per group of frames
+            while len(batch) < GOP_SIZE:
+                try:
+                    batch.append(self._write_queue.get_nowait())
+                except queue.Empty:
+                    break
+            for frame in batch:
+                if frame is None:
+                    done = True
+                    break
+                self.recorder.addFrame(frame)
+                # Hand the buffer back for reuse
+                self._free_frames.put_nowait(frame)
+
+    def stop_recording(self):
+        """Flush the writer thread and finalize the recording"""
+        self._write_queue.put(None)
+        self._writer.join()
+        self.recorder.stop()
+
+    def _copy_to_scratch(self, frame):
+        """Copy a frame's planes into a scratch frame from the free list"""
+        if not self._pool_built:
+            for _ in range(GOP_SIZE):
+                self._free_frames.put_nowait(
+                    av.VideoFrame(frame.width, frame.height, frame.format.name))
+            self._pool_built = True
+        try:
+            scratch = self._free_frames.get_nowait()
+        except queue.Empty:
+            # Recording fell behind and the writer owns every buffer -
+            # drop the frame rather than stall every viewer on this recv
+            return None
+        for src, dst in zip(frame.planes, scratch.planes):
+            if src.line_size == dst.line_size:
+                np.copyto(np.frombuffer(dst, dtype=np.uint8),
+                          np.frombuffer(src, dtype=np.uint8))
+                continue
+            # The decoder and av.VideoFrame can pad rows differently for
+            # some widths; copy row-wise up to the narrower stride so the
+            # buffers never mismatch on odd resolutions
+            src_rows = np.frombuffer(src, dtype=np.uint8).reshape(src.height, src.line_size)
+            dst_rows = np.frombuffer(dst, dtype=np.uint8).reshape(dst.height, dst.line_size)
+            n = min(src.line_size, dst.line_size)
+            dst_rows[:, :n] = src_rows[:, :n]
+        scratch.pts = frame.pts
+        scratch.time_base = frame.time_base
+        return scratch
+
+    async def recv(self):
+        frame = await self.track.recv()
+        if self._started.is_set():
+            scratch = self._copy_to_scratch(frame)
+            if scratch is not None:
+                # Cannot overflow: the queue bound matches the pool size
+                self._write_queue.put_nowait(scratch)
+        return frame
+
+async def cleanup_peer_connection(client_id):
+    """Close a peer connection and finalize any recording it owned"""
+    async with state_lock:
+        pc = active_peer_connections.pop(client_id, None)
+        processor = processors.pop(client_id, None)
+    if processor is not None:
+        await processor.finalize()
+    if pc is not None:
+        await pc.close()
+        print(f"[{client_id}] Connection closed")
+
+# Shared event handlers bound per connection with functools.partial -
+# avoids allocating fresh closures for every peer at high churn
+async def _on_ice_state_change(pc, client_id):
+    print(f"[{client_id}] ICE state: {pc.iceConnectionState}")
+    if pc.iceConnectionState == "failed":
+        await cleanup_peer_connection(client_id)
+
+async def _drain_recording(track):
+    """Consume a relay subscription so its source keeps being pulled"""
+    try:
+        while True:
+            await track.recv()
+    except Exception:
+        pass
+
+def _on_ingest_track(client_id, track):
+    print(f"[{client_id}] Track received: {track.kind}")
+    if track.kind == "video":
+        # Keyed per ingest so a second camera no longer orphans the
+        # first recording; viewers subscribe to these individually
+        processor = VideoFrameProcessor(track, client_id)
+        processors[client_id] = processor
+        # A CCTV recorder must record with zero viewers connected, and
+        # processor.recv only runs when someone pulls it through the
+        # relay - so subscribe our own proxy and drain it. This also
+        # keeps aiortc's per-track frame queue from piling up while no
+        # viewer is attached.
+        processor._drain_task = asyncio.create_task(
+            _drain_recording(relay.subscribe(processor, buffered=False)))
+
+async def handle_offer(request):
+    """Answer an ingest (camera) offer and start recording its video track"""
+    params = await request.json()
+    offer = RTCSessionDescription(sdp=params["sdp"], type=params["type"])
+
+    client_id = str(uuid.uuid4())[:8]
+    pc = RTCPeerConnection()
+    active_peer_connections[client_id] = pc
+
+    pc.on("iceconnectionstatechange",
+          functools.partial(_on_ice_state_change, pc, client_id))
+    pc.on("track", functools.partial(_on_ingest_track, client_id))
+
+    await pc.setRemoteDescription(offer)
+    answer = await pc.createAnswer()
+    await pc.setLocalDescription(answer)
+
+    return web.Response(
+        content_type="application/json",
+        headers=_CORS_HEADERS,
+        body=orjson.dumps({
+            "sdp": pc.localDescription.sdp,
+            "type": pc.localDescription.type,
+        }),
+    )
+
+async def handle_viewer_offer(request):
+    """Answer a viewer offer with the shared ingest track"""
+    params = await request.json()
+    offer = RTCSessionDescription(sdp=params["sdp"], type=params["type"])
+
+    client_id = str(uuid.uuid4())[:8]
+    pc = RTCPeerConnection()
+    active_peer_connections[client_id] = pc
+
+    pc.on("iceconnectionstatechange",
+          functools.partial(_on_ice_state_change, pc, client_id))
+
+    # Pick the requested ingest (?source=<ingest_id>) or the newest one
+    async with state_lock:
+        source = request.query.get("source")
+        if source in processors:
+            processor = processors[source]
+        else:
+            processor = next(reversed(processors.values()), None)
+
+    if processor is not None:
+        # Unbuffered: a slow viewer drops frames instead of queueing them,
+        # keeping per-subscriber memory and latency bounded
+        pc.addTrack(relay.subscribe(processor, buffered=False))
+    else:
+        print(f"[{client_id}] No ingest track available yet")
+
+    await pc.setRemoteDescription(offer)
+    answer = await pc.createAnswer()
+    await pc.setLocalDescription(answer)
+
+    return web.Response(
+        content_type="application/json",
+        headers=_CORS_HEADERS,
+        body=orjson.dumps({
+            "sdp": pc.localDescription.sdp,
+            "type": pc.localDescription.type,
+        }),
+    )
+
+async def handle_preflight(request):
+    return web.Response(headers=_CORS_HEADERS)
+
+# Frontend files preloaded at startup: path -> (body, gzipped body, type).
+# Serving from this dict skips the open/read and per-hit compression that
+# add_static pays on every request.
+_STATIC_CACHE = {}
+
+def _build_static_cache():
+    if not os.path.isdir(STATIC_PATH):
+        return
+    for root, _, files in os.walk(STATIC_PATH):
+        for name in files:
+            full_path = os.path.join(root, name)
+            rel_path = os.path.relpath(full_path, STATIC_PATH).replace(os.sep, "/")
+            with open(full_path, 'rb') as f:
+                body = f.read()
+            content_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+            _STATIC_CACHE["/" + rel_path] = (body, gzip.compress(body, 9), content_type)
+    if "/index.html" in _STATIC_CACHE:
+        _STATIC_CACHE["/"] = _STATIC_CACHE["/index.html"]
+
+async def handle_static(request):
+    entry = _STATIC_CACHE.get(request.path)
+    if entry is None:
+        raise web.HTTPNotFound()
+    body, gzipped, content_type = entry
+    if "gzip" in request.headers.get("Accept-Encoding", ""):
+        headers = dict(_CORS_HEADERS)
+        headers["Content-Encoding"] = "gzip"
+        return web.Response(body=gzipped, content_type=content_type, headers=headers)
+    return web.Response(body=body, content_type=content_type, headers=_CORS_HEADERS)
+
+async def on_shutdown(app):
+    # Close remaining peer connections in chunks, so DTLS teardown runs in
+    # parallel without thousands of closes starving one event-loop turn
+    coros = [pc.close() for pc in active_peer_connections.values()]
+    for chunk in itertools.batched(coros, 64):
+        await asyncio.gather(*chunk)
+    active_peer_connections.clear()
+    for processor in processors.values():
+        await processor.finalize()
+    processors.clear()
+
+def create_app():
+    app = web.Application()
+    app.router.add_post("/offer", handle_offer)
+    app.router.add_post("/viewer_offer", handle_viewer_offer)
+    app.router.add_route("OPTIONS", "/{tail:.*}", handle_preflight)
+    _build_static_cache()
+    if _STATIC_CACHE:
+        app.router.add_get("/{tail:.*}", handle_static)
+    app.on_shutdown.append(on_shutdown)
+    return app
+
+if __name__ == "__main__":
+    web.run_app(create_app(), host="0.0.0.0", port=52050)